@@ -1,61 +1,197 @@
-from typing import Dict, List, NamedTuple
+import itertools
+import os
+from typing import Dict, Iterator, List, NamedTuple, Sequence
 
+import numpy as np
 import pandas as pd
 import torch
-from torch.utils.data import Dataset, DataLoader
-from transformers import AutoTokenizer
+from torch.utils.data import Dataset, DataLoader, Sampler
+from transformers import AutoTokenizer, PreTrainedTokenizerBase
 
 
 class ProteinData(NamedTuple):
-    ligand: str
-    protein: str
-    ic50: int
+    input_ids: np.ndarray
+    token_type_ids: np.ndarray
+    ic50: torch.Tensor
 
 
 class ProteinSMILESDataset(Dataset):
-    def __init__(self, df: pd.DataFrame) -> None:
-        self.df = df
+    def __init__(self, df: pd.DataFrame, tokenizer: PreTrainedTokenizerBase) -> None:
+        # tokenize every pair once up front, batches then only need padding
+        encodings = tokenizer(
+            list(df["Ligand SMILES"]),
+            list(df["BindingDB Target Chain Sequence"]),
+            padding=False,
+            truncation=True,
+            return_attention_mask=False,
+            return_tensors=None,
+        )
+
+        # keep the ids in flat int32 arrays indexed by offsets rather than as
+        # per-token python ints, forked workers would otherwise each end up
+        # copying the whole encoded dataset as they touch refcounts
+        self.lengths = np.fromiter(
+            (len(ids) for ids in encodings["input_ids"]),
+            dtype=np.int64,
+            count=len(df),
+        )
+        # sample i spans offsets[i]:offsets[i + 1], which only holds for
+        # non-negative i, so __getitem__ normalizes negative indices first
+        self.offsets = np.zeros(len(df) + 1, dtype=np.int64)
+        np.cumsum(self.lengths, out=self.offsets[1:])
+
+        num_tokens = int(self.offsets[-1])
+        self.input_ids = np.fromiter(
+            itertools.chain.from_iterable(encodings["input_ids"]),
+            dtype=np.int32,
+            count=num_tokens,
+        )
+        self.token_type_ids = np.fromiter(
+            itertools.chain.from_iterable(encodings["token_type_ids"]),
+            dtype=np.int32,
+            count=num_tokens,
+        )
+        self.labels = torch.tensor(df["IC50 (nM)"].to_numpy(), dtype=torch.float32)
 
     def __len__(self) -> int:
-        return len(self.df)
+        return len(self.labels)
 
     def __getitem__(self, idx: int) -> ProteinData:
-        row = self.df.iloc[idx]
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError(f"index {idx} is out of range")
 
-        ligand = row["Ligand SMILES"]
-        protein = row["BindingDB Target Chain Sequence"]
-        target_ic50 = row["IC50 (nM)"]
+        start, end = self.offsets[idx], self.offsets[idx + 1]
 
-        data = ProteinData(ligand, protein, target_ic50)
+        data = ProteinData(
+            self.input_ids[start:end],
+            self.token_type_ids[start:end],
+            self.labels[idx],
+        )
 
         return data
 
 
+class LengthBucketSampler(Sampler[List[int]]):
+    def __init__(
+        self,
+        lengths: Sequence[int],
+        batch_size: int,
+        shuffle: bool = True,
+        drop_last: bool = False,
+        bucket_size_multiplier: int = 50,
+    ) -> None:
+        if batch_size <= 0:
+            raise ValueError(
+                f"batch_size should be a positive integer, got {batch_size}"
+            )
+        if bucket_size_multiplier <= 0:
+            raise ValueError(
+                "bucket_size_multiplier should be a positive integer, "
+                f"got {bucket_size_multiplier}"
+            )
+
+        self.lengths = lengths
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.bucket_size = batch_size * bucket_size_multiplier
+
+    def __iter__(self) -> Iterator[List[int]]:
+        if self.shuffle:
+            indices = torch.randperm(len(self.lengths)).tolist()
+        else:
+            indices = list(range(len(self.lengths)))
+
+        # sort by length only within random buckets of several batches, so each
+        # batch pads little but its members still change from epoch to epoch
+        batches = []
+        for start in range(0, len(indices), self.bucket_size):
+            bucket = sorted(
+                indices[start : start + self.bucket_size],
+                key=lambda idx: self.lengths[idx],
+            )
+            batches.extend(
+                bucket[i : i + self.batch_size]
+                for i in range(0, len(bucket), self.batch_size)
+            )
+
+        # buckets hold whole batches, so only the very last batch can be short
+        if self.drop_last and batches and len(batches[-1]) < self.batch_size:
+            batches.pop()
+
+        if self.shuffle:
+            batches = [batches[i] for i in torch.randperm(len(batches)).tolist()]
+
+        yield from batches
+
+    def __len__(self) -> int:
+        if self.drop_last:
+            return len(self.lengths) // self.batch_size
+
+        return (len(self.lengths) + self.batch_size - 1) // self.batch_size
+
+
 class TransformerCollate():
     def __init__(self, path: str) -> None:
         self.tokenizer = AutoTokenizer.from_pretrained(path)
+        if not self.tokenizer.is_fast:
+            raise ValueError(f"Expected a fast (Rust) tokenizer at {path}")
 
     def __call__(self, batches: List[ProteinData]) -> Dict[str, torch.Tensor]:
-        ligands = [item.ligand for item in batches]
-        proteins = [item.protein for item in batches]
+        # the attention mask is all ones before padding, tokenizer.pad builds it
+        features = {
+            "input_ids": [item.input_ids.tolist() for item in batches],
+            "token_type_ids": [item.token_type_ids.tolist() for item in batches],
+        }
         target_ic50 = [item.ic50 for item in batches]
 
-        encodings = self.tokenizer(
-            ligands, proteins, padding=True, truncation=True, return_tensors="pt"
+        # multiples of 8 keep sequence lengths on the fp16 tensor core fast path
+        encodings = self.tokenizer.pad(
+            features, padding=True, pad_to_multiple_of=8, return_tensors="pt"
         )
 
-        encodings["labels"] = torch.tensor(target_ic50)
+        # narrower dtypes halve the bytes copied to the device, nn.Embedding takes int32
+        encodings["input_ids"] = encodings["input_ids"].to(torch.int32)
+        encodings["token_type_ids"] = encodings["token_type_ids"].to(torch.int32)
+        encodings["attention_mask"] = encodings["attention_mask"].to(torch.bool)
+
+        encodings["labels"] = torch.stack(target_ic50)
 
         return encodings
 
 
 def main() -> None:
-    df = pd.read_csv("./BindingDB_EQ_IC50_Subset.tsv", sep="\t")
-
-    dataset = ProteinSMILESDataset(df)
+    df = pd.read_csv(
+        "./BindingDB_EQ_IC50_Subset.tsv",
+        sep="\t",
+        engine="pyarrow",
+        usecols=["Ligand SMILES", "BindingDB Target Chain Sequence", "IC50 (nM)"],
+        dtype={
+            "Ligand SMILES": "string",
+            "BindingDB Target Chain Sequence": "string",
+            "IC50 (nM)": "float32",
+        },
+    )
 
     collate_fn = TransformerCollate("Chem_Tokenizer_3")
-    dataloader = DataLoader(dataset, batch_size=4, shuffle=True, collate_fn=collate_fn)
+
+    dataset = ProteinSMILESDataset(df, collate_fn.tokenizer)
+
+    # persistent_workers and prefetch_factor both require at least one worker,
+    # more than a few is wasted now that workers only pad pre-tokenized ids
+    num_workers = min(4, max(1, (os.cpu_count() or 2) // 2))
+    batch_sampler = LengthBucketSampler(dataset.lengths, batch_size=4)
+    dataloader = DataLoader(
+        dataset,
+        batch_sampler=batch_sampler,
+        collate_fn=collate_fn,
+        pin_memory=True,
+        num_workers=num_workers,
+        persistent_workers=True,
+        prefetch_factor=4,
+    )
 
     print(dataset[0])
 